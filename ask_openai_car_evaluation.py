@@ -12,7 +12,11 @@ import glob
 from openai import OpenAI
 from dotenv import load_dotenv
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Iterable, Iterator
+from similitud_coches import (
+    clave_bloqueo, firma_minhash, buscar_similar, añadir_al_indice, cargar_indice, guardar_indice, heredar_analisis,
+    extraer_precio
+)
 
 # 1) ------------- Cargar clave desde .env -----------------
 load_dotenv()
@@ -29,6 +33,9 @@ MODELO_ANALISIS = os.getenv("OPENAI_MODEL_ANALISIS", "gpt-4o-mini")
 # Archivo para guardar análisis histórico completo
 ARCHIVO_ANALISIS = os.path.join(DATA_DIR, "analisis.json")
 
+# Índice de similitud con los análisis ya pagados, para reutilizarlos en coches equivalentes
+ARCHIVO_INDICE_SIMILITUD = ARCHIVO_ANALISIS.split('.')[0] + "_indice_similitud.json"
+
 # 2) ------------- Prompt para análisis --------------------------------
 
 PROMPT_ANALISIS_SYSTEM = """
@@ -88,8 +95,8 @@ beneficio_neto:
 = ingresos_mensuales - coste_renting
 
 Salida:
-Devuelve ÚNICAMENTE un JSON puro, sin texto extra ni marcas de formato, con una lista de objetos.
-Cada objeto debe contener:
+Devuelve ÚNICAMENTE un JSON puro, sin texto extra ni marcas de formato, con un objeto {"coches": [...]}.
+Cada objeto de la lista "coches" debe contener:
 url, precio_alquiler_dia, ingresos_mensuales, coste_renting, beneficio_neto, etiqueta_ambiental, consumo, puntos_extra, ponderación, segmento
 """
 # Plantilla para el mensaje del usuario
@@ -121,13 +128,49 @@ Instrucciones:
 10. Devolver todos los datos calculados y el segmento detectado.
 
 Salida:
-Devolver SOLO un JSON con una lista de objetos, cada uno con:
+Devolver SOLO un JSON con la clave "coches" y una lista de objetos, cada uno con:
 url, precio_alquiler_dia, ingresos_mensuales, coste_renting, beneficio_neto, etiqueta_ambiental, consumo, puntos_extra, ponderación, segmento
 
 Coches:
 {json_coches}
 """
 
+# Esquema estricto de la salida: el modelo no puede devolver otros campos ni otros valores de etiqueta.
+# Structured Outputs exige un objeto en la raíz, por eso la lista va dentro de "coches".
+CAMPOS_ANALISIS = {
+    "url": {"type": "string"},
+    "precio_alquiler_dia": {"type": "number"},
+    "ingresos_mensuales": {"type": "number"},
+    "coste_renting": {"type": "number"},
+    "beneficio_neto": {"type": "number"},
+    "etiqueta_ambiental": {"type": "string", "enum": ["0", "ECO", "C", "B", "NO DETERMINADO"]},
+    "consumo": {"type": "number"},
+    "puntos_extra": {"type": "integer"},
+    "ponderación": {"type": "string"},
+    "segmento": {"type": "string"},
+}
+
+ESQUEMA_ANALISIS = {
+    "name": "analisis_coches",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "coches": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": CAMPOS_ANALISIS,
+                    "required": list(CAMPOS_ANALISIS),
+                    "additionalProperties": False,
+                },
+            }
+        },
+        "required": ["coches"],
+        "additionalProperties": False,
+    },
+}
+
 # ------------- Carga de datos -------------------------
 def cargar_coches(path: str):
     """Generador de dicts coche desde JSON o JSONL."""
@@ -156,52 +199,129 @@ def cargar_coches(path: str):
 
 
 
-def analizar_coches_para_renting(lista_coches: List[Dict]) -> str:
+def extraer_coches_en_stream(fragmentos: Iterable[str]) -> Iterator[Dict]:
+    """
+    Parser JSON incremental: devuelve cada objeto coche en cuanto se cierra su llave,
+    sin esperar al final de la respuesta. Solo guarda en memoria el objeto en curso.
+    Lo que haya fuera de los objetos (marcas de formato, texto) se ignora.
+    """
+    pila = []
+    en_cadena = escapado = False
+    buffer = []
+    nivel_captura = None
+
+    for fragmento in fragmentos:
+        for ch in fragmento:
+            if nivel_captura is not None:
+                buffer.append(ch)
+
+            if en_cadena:
+                if escapado:
+                    escapado = False
+                elif ch == "\\":
+                    escapado = True
+                elif ch == '"':
+                    en_cadena = False
+                continue
+
+            if ch == '"':
+                en_cadena = True
+            elif ch in "{[":
+                # Un objeto directamente dentro de una lista es un coche
+                if ch == "{" and nivel_captura is None and pila and pila[-1] == "[":
+                    nivel_captura = len(pila)
+                    buffer = [ch]
+                pila.append(ch)
+            elif ch in "}]":
+                if pila:
+                    pila.pop()
+                if ch == "}" and nivel_captura is not None and len(pila) == nivel_captura:
+                    nivel_captura = None
+                    try:
+                        yield json.loads("".join(buffer))
+                    except json.JSONDecodeError as e:
+                        print(f"⚠️ Objeto JSON inválido en la respuesta, se descarta: {e}")
+                    buffer = []
+
+
+def _fragmentos_de_stream(stream) -> Iterator[str]:
+    """Texto de cada chunk del stream. Si la respuesta se corta, se conserva lo ya recibido."""
+    rechazo = ""
+    try:
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            eleccion = chunk.choices[0]
+            if getattr(eleccion.delta, "refusal", None):
+                rechazo += eleccion.delta.refusal
+            if eleccion.delta.content:
+                yield eleccion.delta.content
+            if eleccion.finish_reason == "length":
+                print("⚠️ La respuesta de OpenAI se cortó por límite de tokens. El análisis es parcial.")
+            elif eleccion.finish_reason == "content_filter":
+                print("⚠️ La respuesta de OpenAI se cortó por el filtro de contenido. El análisis es parcial.")
+    except Exception as e:
+        print(f"⚠️ La respuesta de OpenAI se interrumpió: {e}. Se conservan los coches ya recibidos.")
+    if rechazo:
+        print(f"⚠️ OpenAI rechazó el análisis: {rechazo}")
+
+
+def analizar_coches_para_renting(lista_coches: List[Dict]) -> Iterator[Dict]:
     """
-    Envía la lista de coches a OpenAI para un análisis comparativo y una recomendación clara.
+    Envía la lista de coches a OpenAI y devuelve el análisis de cada coche a medida que llega.
     """
 
     user_msg = PROMPT_ANALISIS_USER_TEMPLATE.format(json_coches=json.dumps(lista_coches, ensure_ascii=False, indent=2))
 
-    resp = client.chat.completions.create(
+    stream = client.chat.completions.create(
         model=MODELO_ANALISIS,
         temperature=0.0,  # Máxima consistencia
         messages=[
             {"role": "system", "content": PROMPT_ANALISIS_SYSTEM},
             {"role": "user", "content": user_msg}
-        ]
+        ],
+        response_format={"type": "json_schema", "json_schema": ESQUEMA_ANALISIS},
+        stream=True,
     )
-    
-    analisis_coches_nuevos = resp.choices[0].message.content.strip()
 
+    recibidas = set()
+    for analisis in extraer_coches_en_stream(_fragmentos_de_stream(stream)):
+        recibidas.add(analisis.get("url"))
+        yield analisis
 
-    return  analisis_coches_nuevos
+    faltan = [coche.get("url") for coche in lista_coches if coche.get("url") not in recibidas]
+    if faltan:
+        print(f"⚠️ Análisis parcial: faltan {len(faltan)} de {len(lista_coches)} coches:")
+        for url in faltan:
+            print(f"   - {url}")
 
-def ponderar_coches(coches: List[Dict]) -> List[Dict]:
+def ponderar_coche(coche: Dict) -> Dict:
     """
-    Pondera los coches según su rentabilidad y otros factores.
+    Pondera un coche según su rentabilidad y otros factores.
     """
     # Reglas si el km_por_año < 10.000
-    for coche in coches:
-        if coche.get("km_por_año", 0) < 10000:
-            coche["puntos_extra"] = coche.get("puntos_extra", 0) + 1
-            coche["ponderación"] =  coche.get("ponderación", "") + "* Kms por año menor de 10.000 * "
-        if coche.get("beneficio_neto", 0) > 0 < 50:
-            coche["puntos_extra"] = coche.get("puntos_extra", 0) + 1
-            coche["ponderación"] = coche.get("ponderación", "") + "* Beneficio neto positivo * "
-        if coche.get("beneficio_neto") > 50:
-            coche["puntos_extra"] = coche.get("puntos_extra", 0) + 1
-            coche["ponderación"] = coche.get("ponderación", "") + "* Beneficio neto alto *"
-        if coche.get("etiqueta_ambiental") == "0" or coche.get("etiqueta_ambiental") == "ECO":
-            coche["puntos_extra"] = coche.get("puntos_extra", 0) + 1
-            coche["ponderación"] = coche.get("ponderación", "") + "* Etiqueta ambiental 0 o ECO *"
-        if coche.get("consumo", 0) < 5.5:
-            coche["puntos_extra"] = coche.get("puntos_extra", 0) + 1
-            coche["ponderación"] = coche.get("ponderación", "") + "* Consumo menor de 5.5 l/100km *"
-    # Ordenar por beneficio neto
-    coches = sorted(coches, key=lambda x: (x.get("beneficio_neto", 0)), reverse=True)
-
-    return coches
+    if coche.get("km_por_año", 0) < 10000:
+        coche["puntos_extra"] = coche.get("puntos_extra", 0) + 1
+        coche["ponderación"] =  coche.get("ponderación", "") + "* Kms por año menor de 10.000 * "
+    if coche.get("beneficio_neto", 0) > 0 < 50:
+        coche["puntos_extra"] = coche.get("puntos_extra", 0) + 1
+        coche["ponderación"] = coche.get("ponderación", "") + "* Beneficio neto positivo * "
+    if coche.get("beneficio_neto") > 50:
+        coche["puntos_extra"] = coche.get("puntos_extra", 0) + 1
+        coche["ponderación"] = coche.get("ponderación", "") + "* Beneficio neto alto *"
+    if coche.get("etiqueta_ambiental") == "0" or coche.get("etiqueta_ambiental") == "ECO":
+        coche["puntos_extra"] = coche.get("puntos_extra", 0) + 1
+        coche["ponderación"] = coche.get("ponderación", "") + "* Etiqueta ambiental 0 o ECO *"
+    if coche.get("consumo", 0) < 5.5:
+        coche["puntos_extra"] = coche.get("puntos_extra", 0) + 1
+        coche["ponderación"] = coche.get("ponderación", "") + "* Consumo menor de 5.5 l/100km *"
+    return coche
+
+def ordenar_por_beneficio(coches: List[Dict]) -> List[Dict]:
+    """
+    Ordena los coches por beneficio neto, de mayor a menor.
+    """
+    return sorted(coches, key=lambda x: (x.get("beneficio_neto", 0)), reverse=True)
 
 def crear_informe(coches: List[Dict]) -> str:
     """
@@ -301,30 +421,75 @@ def main():
         print("🎉 Proceso completado solo con histórico. ¡Consulta los archivos generados en la carpeta data! 🚀")
         return
 
-    print("🤖 Enviando coches nuevos a OpenAI para análisis...")
-    analisis_coches_nuevos = analizar_coches_para_renting(coches_nuevos)
-    print("✅ Análisis de coches para renting completado de los coches nuevos.")
+    print("🧬 Buscando coches equivalentes ya analizados...")
+    indice = cargar_indice(ARCHIVO_INDICE_SIMILITUD)
+    coches_a_analizar = []
+    entradas_por_url = {}
+    equivalentes = []  # (coche, entrada del índice cuyo análisis hereda)
+    for coche in coches_nuevos:
+        clave = clave_bloqueo(coche)
+        if clave is None:
+            # Sin modelo, motor, año o descripción no se puede asegurar la equivalencia
+            coches_a_analizar.append(coche)
+            continue
+        firma = firma_minhash(coche)
+        precio = extraer_precio(coche.get("precio"))
+        entrada = buscar_similar(indice, clave, firma, precio)
+        if entrada is None:
+            entradas_por_url[coche.get("url")] = añadir_al_indice(indice, coche.get("url"), clave, firma, precio, None)
+            coches_a_analizar.append(coche)
+        else:
+            equivalentes.append((coche, entrada))
+    print(f"✅ {len(equivalentes)} coches equivalentes a otros ya analizados, {len(coches_a_analizar)} por analizar.")
+
+    analisis_coches_nuevos = []
+    coches_nuevos_actualizados = []
+    coches_nuevos_ponderados = []
+
+    def fusionar_analisis(coche: Dict, analisis: Dict):
+        coche.update(analisis)
+        coches_nuevos_actualizados.append(dict(coche))
+        coches_nuevos_ponderados.append(ponderar_coche(coche))
+        print(f"  ✔️ {coche.get('modelo', '')}: beneficio neto {coche.get('beneficio_neto')}")
+
+    if coches_a_analizar:
+        print("🤖 Enviando coches nuevos a OpenAI para análisis (streaming)...")
+        coches_nuevos_por_url = {coche.get("url"): coche for coche in coches_a_analizar}
+        # Cada coche se fusiona y pondera en cuanto su objeto JSON está completo en el stream
+        for analisis in analizar_coches_para_renting(coches_a_analizar):
+            analisis_coches_nuevos.append(analisis)
+            coche = coches_nuevos_por_url.pop(analisis.get("url"), None)
+            if not coche:
+                print(f"⚠️ Análisis recibido para una URL desconocida o repetida: {analisis.get('url')}")
+                continue
+            if coche.get("url") in entradas_por_url:
+                entradas_por_url[coche.get("url")]["analisis"] = dict(analisis)
+            fusionar_analisis(coche, analisis)
+        print(f"✅ Análisis de coches para renting completado: {len(analisis_coches_nuevos)} de {len(coches_a_analizar)} coches enviados.")
+
+    print("♻️ Reutilizando análisis de coches equivalentes...")
+    reutilizados = 0
+    for coche, entrada in equivalentes:
+        if not entrada.get("analisis"):
+            print(f"⚠️ El coche equivalente a {coche.get('url')} no llegó a analizarse. Se omite.")
+            continue
+        fusionar_analisis(coche, heredar_analisis(coche, entrada["analisis"]))
+        reutilizados += 1
+    llamada_omitida = " (llamada a OpenAI omitida)" if not coches_a_analizar else ""
+    print(f"💸 Análisis evitados por similitud: {reutilizados} de {len(coches_nuevos)} coches nuevos{llamada_omitida}.")
+
+    print("💾 Guardando índice de similitud...")
+    guardar_indice(indice, ARCHIVO_INDICE_SIMILITUD)
 
     print("💾 Guardando análisis de coches nuevos en JSON...")
     with open(ARCHIVO_ANALISIS.split('.')[0] + "_coches_nuevos.json", "w", encoding="utf-8") as f:
-        f.write(analisis_coches_nuevos)
+        f.write(json.dumps(analisis_coches_nuevos, ensure_ascii=False, indent=2))
 
-    print("🔄 Actualizando información de coches con análisis...")
-    coches_nuevos_actualizados = []
-    for analisis in json.loads(analisis_coches_nuevos):
-        url = analisis.get("url")
-        if url:
-            for coche in coches_nuevos:
-                if coche.get("url") == url:
-                    coche.update(analisis)
-                    coches_nuevos_actualizados.append(coche)
-                    break
     print(f"💾 Guardando {len(coches_nuevos_actualizados)} coches nuevos actualizados...")
     with open(ARCHIVO_ANALISIS.split('.')[0] + "_coches_nuevos_actualizados.json", "w", encoding="utf-8") as f:
         f.write(json.dumps(coches_nuevos_actualizados, ensure_ascii=False, indent=2))
 
-    print("📊 Ponderando coches según reglas de rentabilidad...")
-    coches_nuevos_ponderados = ponderar_coches(coches_nuevos_actualizados)
+    coches_nuevos_ponderados = ordenar_por_beneficio(coches_nuevos_ponderados)
     print(f"✅ Coches nuevos ponderados: {len(coches_nuevos_ponderados)} coches.")
 
     print("💾 Guardando coches nuevos ponderados...")
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cola de trabajos local y persistente sobre SQLite.
+• El coordinador encola los coches a enriquecer y varios procesos worker los van reclamando.
+• Sobrevive a caídas: los trabajos que quedaron "en_curso" se vuelven a poner en "pendiente".
+"""
+
+import json
+import sqlite3
+from datetime import datetime
+from typing import List, Dict, Optional, Tuple
+
+MAX_INTENTOS = 3
+
+
+def conectar(path: str) -> sqlite3.Connection:
+    """Abre (y crea si hace falta) la cola. Cada proceso debe abrir su propia conexión."""
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS trabajos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            url TEXT UNIQUE NOT NULL,
+            payload TEXT NOT NULL,
+            estado TEXT NOT NULL DEFAULT 'pendiente',
+            intentos INTEGER NOT NULL DEFAULT 0,
+            resultado TEXT,
+            actualizado TEXT
+        )
+        """
+    )
+    return conn
+
+
+def _ahora() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def encolar(conn: sqlite3.Connection, coche: Dict):
+    """Encola un coche. Si su URL ya estaba en la cola, se reemplaza (deduplicación por URL)."""
+    conn.execute(
+        """
+        INSERT INTO trabajos (url, payload, estado, intentos, resultado, actualizado)
+        VALUES (?, ?, 'pendiente', 0, NULL, ?)
+        ON CONFLICT(url) DO UPDATE SET
+            payload = excluded.payload, estado = 'pendiente', intentos = 0,
+            resultado = NULL, actualizado = excluded.actualizado
+        """,
+        (coche["url"], json.dumps(coche, ensure_ascii=False), _ahora()),
+    )
+
+
+def reclamar(conn: sqlite3.Connection) -> Optional[Tuple[int, Dict]]:
+    """Reserva de forma atómica el siguiente trabajo pendiente. Devuelve (id, coche) o None."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        fila = conn.execute(
+            "SELECT id, payload FROM trabajos WHERE estado = 'pendiente' ORDER BY id LIMIT 1"
+        ).fetchone()
+        if fila:
+            conn.execute(
+                "UPDATE trabajos SET estado = 'en_curso', actualizado = ? WHERE id = ?",
+                (_ahora(), fila[0]),
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return (fila[0], json.loads(fila[1])) if fila else None
+
+
+def completar(conn: sqlite3.Connection, trabajo_id: int, coche: Dict):
+    conn.execute(
+        "UPDATE trabajos SET estado = 'hecho', resultado = ?, actualizado = ? WHERE id = ?",
+        (json.dumps(coche, ensure_ascii=False), _ahora(), trabajo_id),
+    )
+
+
+def fallar(conn: sqlite3.Connection, trabajo_id: int):
+    """Devuelve el trabajo a la cola, o lo marca como "error" si agotó los intentos."""
+    conn.execute(
+        """
+        UPDATE trabajos SET
+            intentos = intentos + 1,
+            estado = CASE WHEN intentos + 1 >= ? THEN 'error' ELSE 'pendiente' END,
+            actualizado = ?
+        WHERE id = ?
+        """,
+        (MAX_INTENTOS, _ahora(), trabajo_id),
+    )
+
+
+def reiniciar_en_curso(conn: sqlite3.Connection) -> int:
+    """Recupera los trabajos de workers que murieron a mitad. Devuelve cuántos."""
+    return conn.execute(
+        "UPDATE trabajos SET estado = 'pendiente', actualizado = ? WHERE estado = 'en_curso'",
+        (_ahora(),),
+    ).rowcount
+
+
+def contar_pendientes(conn: sqlite3.Connection) -> int:
+    """Trabajos sin terminar, incluidos los reservados por algún worker."""
+    return conn.execute(
+        "SELECT COUNT(*) FROM trabajos WHERE estado IN ('pendiente', 'en_curso')"
+    ).fetchone()[0]
+
+
+def contar_sin_reclamar(conn: sqlite3.Connection) -> int:
+    """Trabajos que ningún worker ha reservado todavía."""
+    return conn.execute("SELECT COUNT(*) FROM trabajos WHERE estado = 'pendiente'").fetchone()[0]
+
+
+def resultados(conn: sqlite3.Connection) -> List[Dict]:
+    """Coches terminados. Los que fallaron se devuelven con los datos del listado."""
+    filas = conn.execute(
+        "SELECT estado, payload, resultado FROM trabajos WHERE estado IN ('hecho', 'error') ORDER BY id"
+    ).fetchall()
+    return [json.loads(resultado if estado == "hecho" else payload) for estado, payload, resultado in filas]
+
+
+def vaciar(conn: sqlite3.Connection):
+    """Borra los trabajos ya terminados una vez fusionados en el archivo de coches."""
+    conn.execute("DELETE FROM trabajos WHERE estado IN ('hecho', 'error')")
+
+
+def descartar(conn: sqlite3.Connection, urls: List[str]):
+    """Borra los trabajos de estas URLs, terminados o no (ejecución abortada)."""
+    conn.executemany("DELETE FROM trabajos WHERE url = ?", [(url,) for url in urls])
@@ -1,10 +1,17 @@
-from playwright.sync_api import sync_playwright
+from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeoutError
 import json
 import sys
 import os
+import re
+import time
+import signal
+import multiprocessing
 from datetime import datetime
+from urllib.parse import urljoin
 import dotenv
 
+import cola_trabajos
+
 dotenv.load_dotenv()
 
 # Crear directorio de datos si no existe
@@ -14,14 +21,24 @@ if not os.path.exists(DATA_DIR):
 
 ARCHIVO_COCHES_ELIMINADO = os.getenv("ARCHIVO_COCHES_ELIMINADO", os.path.join(DATA_DIR, "coches_eliminados.json"))
 ARCHIVO_COCHES = os.getenv("ARCHIVO_COCHES", os.path.join(DATA_DIR, "coches.json"))
-URL_LISTADO = os.getenv("URL_LISTADO", "https://example.com/listing")  # URL configurable
+URL_LISTADO = os.getenv("URL_LISTADO", "https://example.com/listing")  # Una o varias URLs separadas por comas
+ARCHIVO_COLA = os.getenv("ARCHIVO_COLA", os.path.join(DATA_DIR, "cola_trabajos.sqlite"))
+# "or" en vez de valor por defecto: en GitHub Actions un secret no definido llega como cadena vacía
+NUM_WORKERS = int(os.getenv("NUM_WORKERS") or os.cpu_count() or 1)
+TIMEOUT_WORKERS = int(os.getenv("TIMEOUT_WORKERS") or 1800)  # Segundos máximos por ronda de workers
+RONDAS_WORKERS = 3  # Relanzamientos si algún worker muere con trabajos a medias
+
+SELECTOR_COCHE = "a[href^='/leasing/ald/']"
+SELECTOR_SIGUIENTE = os.getenv("SELECTOR_SIGUIENTE", "a[rel='next']")  # Enlace a la siguiente página del listado
+ESPERA_SCROLL_MS = int(os.getenv("ESPERA_SCROLL_MS", "1500"))
+MAX_SCROLLS_SIN_NOVEDADES = int(os.getenv("MAX_SCROLLS_SIN_NOVEDADES", "2"))
 
 DATE = datetime.now().strftime("%Y-%m-%d")
 
 def extraer_texto(element, default=""):
     return element.inner_text().strip() if element else default
 
-def obtener_detalles_de_coche(page, car: dict) -> dict:
+def obtener_detalles_de_coche(page, car: dict, lanzar_errores: bool = False) -> dict:
     try:
         url = car.get("url", "")
         page.goto(url, wait_until="load", timeout=60000)
@@ -52,6 +69,8 @@ def obtener_detalles_de_coche(page, car: dict) -> dict:
                 if name and value:
                     car[name] = value
     except Exception as e:
+        if lanzar_errores:
+            raise
         print(f"⚠️ Error al obtener detalles de {car.get('url', '')}: {e}", file=sys.stderr)
     return car
 
@@ -82,8 +101,155 @@ def calcular_km_por_año(car_data: dict) -> dict:
     car_data["km_por_año"] = km_por_año
     return car_data
 
-def scrape_coches():
-    url = URL_LISTADO
+def nueva_pagina(browser):
+    page = browser.new_page()
+    page.set_viewport_size({"width": 1280, "height": 800})
+    page.set_extra_http_headers({"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"})
+    return page
+
+def abrir_navegador(p):
+    browser = p.chromium.launch(headless=True, args=["--ignore-certificate-errors"])
+    return browser, nueva_pagina(browser)
+
+def worker_enriquecimiento(ruta_cola: str, listado_terminado):
+    """
+    Proceso worker: con su propio navegador, reclama coches de la cola y les añade los detalles.
+    Termina cuando el coordinador ha acabado de listar y no quedan trabajos sin reclamar;
+    los que otro worker dejó a medias los recupera el coordinador.
+    """
+    # Al detenerlo el coordinador, salir por los finally para cerrar Chromium y el driver de Playwright
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    cola = cola_trabajos.conectar(ruta_cola)
+    with sync_playwright() as p:
+        browser, details_page = abrir_navegador(p)
+        try:
+            while True:
+                trabajo = cola_trabajos.reclamar(cola)
+                if trabajo is None:
+                    if listado_terminado.is_set() and cola_trabajos.contar_sin_reclamar(cola) == 0:
+                        break
+                    time.sleep(0.5)
+                    continue
+
+                trabajo_id, car_data = trabajo
+                try:
+                    obtener_detalles_de_coche(details_page, car_data, lanzar_errores=True)
+                    calcular_km_por_año(car_data)
+                    cola_trabajos.completar(cola, trabajo_id, car_data)
+                except Exception as e:
+                    print(f"⚠️ Error enriqueciendo datos de {car_data.get('url', '')}: {e}", file=sys.stderr)
+                    cola_trabajos.fallar(cola, trabajo_id)
+                    # Página en un estado desconocido tras el error: se empieza con una limpia
+                    details_page.close()
+                    details_page = nueva_pagina(browser)
+        finally:
+            browser.close()
+            cola.close()
+
+def detener_worker(w):
+    """Pide al worker que termine (cierra su navegador) y, si no responde, lo mata."""
+    w.terminate()
+    w.join(30)
+    if w.is_alive():
+        w.kill()
+        w.join()
+
+def lanzar_workers(ctx, num_workers: int, listado_terminado) -> list:
+    workers = [
+        ctx.Process(target=worker_enriquecimiento, args=(ARCHIVO_COLA, listado_terminado), daemon=True)
+        for _ in range(max(1, num_workers))
+    ]
+    for w in workers:
+        w.start()
+    return workers
+
+# href y textos de todos los cards en una sola llamada al navegador, sin dejar ElementHandles vivos
+JS_DATOS_CARDS = """els => els.map(el => {
+    const texto = s => { const e = el.querySelector(s); return e ? e.innerText.trim() : ""; };
+    return {
+        href: el.getAttribute("href"),
+        titulo: texto("h3.mb1.trunc-line"),
+        precio: texto("span.text-bold.text-green-60"),
+        contrato: texto("p.mb1.hidden-xs"),
+        uso: texto("div.text-break-word.hidden-xs span"),
+    };
+})"""
+
+def datos_de_card(card: dict, url: str) -> dict:
+    full_url = f"{url.split('/renting')[0]}{card['href']}"
+    price_text = card["precio"]
+
+    return {
+        "url": full_url,
+        "modelo": card["titulo"],
+        "precio": f"{price_text} € al mes" if price_text else "",
+        "contrato": card["contrato"],
+        "uso": card["uso"]
+    }
+
+def recorrer_listado(listing_page, url: str):
+    """
+    Generador con los datos básicos de cada coche del listado.
+    Hace scroll hasta que no aparecen coches nuevos y sigue la paginación,
+    así el coordinador puede encolar los de la primera página mientras se cargan las siguientes.
+    Solo se guardan los href ya vistos; cada pasada lee href y textos de los cards en una única llamada.
+    """
+    vistos = set()
+    paginas_visitadas = set()
+    pagina = url
+    while pagina and pagina not in paginas_visitadas:
+        paginas_visitadas.add(pagina)
+        try:
+            listing_page.goto(pagina, wait_until="load", timeout=60000)
+            listing_page.wait_for_selector(SELECTOR_COCHE, timeout=60000)
+        except PlaywrightTimeoutError as e:
+            if pagina == url:
+                raise  # Sin la primera página el listado ha fallado
+            print(f"⚠️ Sin coches en {pagina} ({e}). Fin de la paginación.", file=sys.stderr)
+            break
+
+        scrolls_sin_novedades = lecturas_fallidas = 0
+        while scrolls_sin_novedades < MAX_SCROLLS_SIN_NOVEDADES:
+            try:
+                cards = listing_page.eval_on_selector_all(SELECTOR_COCHE, JS_DATOS_CARDS)
+                lecturas_fallidas = 0
+            except Exception as e:
+                # Los cards no quedan como vistos: se vuelven a leer en la siguiente pasada.
+                # Si falla una y otra vez, el listado se da por fallido en vez de por completo.
+                lecturas_fallidas += 1
+                if lecturas_fallidas >= MAX_SCROLLS_SIN_NOVEDADES:
+                    raise
+                print(f"⚠️ No pude leer los cards de {pagina}: {e}", file=sys.stderr)
+                listing_page.wait_for_timeout(ESPERA_SCROLL_MS)
+                continue
+            nuevos = 0
+            for card in cards:
+                if not card["href"] or card["href"] in vistos:
+                    continue
+                vistos.add(card["href"])
+                nuevos += 1
+                yield datos_de_card(card, url)
+
+            scrolls_sin_novedades = 0 if nuevos else scrolls_sin_novedades + 1
+            # Forzar la carga perezosa de más coches
+            listing_page.evaluate("window.scrollTo(0, document.body.scrollHeight)")
+            listing_page.wait_for_timeout(ESPERA_SCROLL_MS)
+
+        siguiente = listing_page.query_selector(SELECTOR_SIGUIENTE)
+        href_siguiente = siguiente.get_attribute("href") if siguiente else None
+        if siguiente:
+            siguiente.dispose()
+        pagina = urljoin(pagina, href_siguiente) if href_siguiente else None
+
+    if not vistos:
+        print(f"⚠️ No se encontraron coches en la página de listado {url}.", file=sys.stderr)
+
+def scrape_coches(urls_listado=None, num_workers: int = NUM_WORKERS):
+    """
+    Coordinador: recorre uno o varios listados, encola en SQLite los coches nuevos o cambiados
+    y deja que num_workers procesos (cada uno con su navegador) obtengan los detalles en paralelo.
+    """
+    urls_listado = urls_listado or [u for u in re.split(r"[,\s]+", URL_LISTADO) if u]
 
     existing_data = []
     existing_by_url = {}
@@ -111,79 +277,99 @@ def scrape_coches():
         existing_data = []
 
     nuevos = actualizados = sin_cambios = eliminados = 0
-    final_data = []
-
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True, args=["--ignore-certificate-errors"])
-        listing_page = browser.new_page()
-        details_page = browser.new_page()
-        listing_page.set_viewport_size({"width": 1280, "height": 800})
-        listing_page.set_extra_http_headers({"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"})
-
-        try:
-            listing_page.goto(url, wait_until="load", timeout=60000)
-            listing_page.wait_for_selector("a[href^='/leasing/ald/']", timeout=60000)
+    final_by_url = {}
 
-            car_cards = listing_page.query_selector_all("a[href^='/leasing/ald/']")
-            if not car_cards:
-                print("⚠️ No se encontraron coches en la página de listado.", file=sys.stderr)
+    cola = cola_trabajos.conectar(ARCHIVO_COLA)
+    recuperados = cola_trabajos.reiniciar_en_curso(cola)
+    if recuperados:
+        print(f"♻️ Recuperados {recuperados} trabajos interrumpidos en la ejecución anterior.")
 
-            for card in car_cards:
-                try:
-                    href = card.get_attribute("href")
-                except Exception as e:
-                    print(f"⚠️ No pude leer href de un card: {e}", file=sys.stderr)
-                    continue
-                full_url = f"{url.split('/renting')[0]}{href}"
-
-                title = card.query_selector("h3.mb1.trunc-line")
-                title_text = extraer_texto(title)
-
-                price_span = card.query_selector("span.text-bold.text-green-60")
-                price_text = extraer_texto(price_span)
-
-                contract_p = card.query_selector("p.mb1.hidden-xs")
-                contract_text = extraer_texto(contract_p)
-
-                use_span = card.query_selector("div.text-break-word.hidden-xs span")
-                use_text = extraer_texto(use_span)
-
-                car_data = {
-                    "url": full_url,
-                    "modelo": title_text,
-                    "precio": f"{price_text} € al mes" if price_text else "",
-                    "contrato": contract_text,
-                    "uso": use_text
-                }
-
-                if full_url not in existing_by_url:
-                    car_data["estado_actualizacion"] = "nuevo"
-                    nuevos += 1
-                elif coche_ha_cambiado(car_data, existing_by_url[full_url]):
-                    car_data["estado_actualizacion"] = "actualizado"
-                    actualizados += 1
-                else:
-                    old_car = existing_by_url[full_url]
-                    old_car["estado_actualizacion"] = "sin_cambios"
-                    final_data.append(old_car)
-                    sin_cambios += 1
-                    continue
+    # Los workers arrancan antes de listar para empezar a enriquecer en cuanto haya trabajos
+    ctx = multiprocessing.get_context("spawn")
+    listado_terminado = ctx.Event()
+    workers = lanzar_workers(ctx, num_workers, listado_terminado)
+    print(f"👷 {len(workers)} workers de enriquecimiento en marcha.")
 
-                try:
-                    obtener_detalles_de_coche(details_page, car_data)
-                    calcular_km_por_año(car_data)
-                except Exception as e:
-                    print(f"⚠️ Error enriqueciendo datos de {full_url}: {e}", file=sys.stderr)
-
-                final_data.append(car_data)
-                print(f"{'🆕' if car_data['estado_actualizacion']=='nuevo' else '🔁'} {title_text}")
-
-            browser.close()
-
-        except Exception as e:
-            print(f"❌ Error al cargar la página de listado: {e}", file=sys.stderr)
-            browser.close()
-            return
+    listados_fallidos = 0
+    encolados = []
+    with sync_playwright() as p:
+        browser, listing_page = abrir_navegador(p)
+
+        for url in urls_listado:
+            print(f"📄 Listado: {url}")
+            try:
+                for car_data in recorrer_listado(listing_page, url):
+                    full_url = car_data["url"]
+                    if full_url in final_by_url:
+                        continue  # Mismo coche en varios listados
+
+                    if full_url not in existing_by_url:
+                        car_data["estado_actualizacion"] = "nuevo"
+                        nuevos += 1
+                    elif coche_ha_cambiado(car_data, existing_by_url[full_url]):
+                        car_data["estado_actualizacion"] = "actualizado"
+                        actualizados += 1
+                    else:
+                        old_car = existing_by_url[full_url]
+                        old_car["estado_actualizacion"] = "sin_cambios"
+                        final_by_url[full_url] = old_car
+                        sin_cambios += 1
+                        continue
+
+                    # Hueco reservado para mantener el orden del listado; lo rellena el resultado del worker
+                    final_by_url[full_url] = car_data
+                    cola_trabajos.encolar(cola, car_data)
+                    encolados.append(full_url)
+                    print(f"{'🆕' if car_data['estado_actualizacion']=='nuevo' else '🔁'} {car_data['modelo']}")
+            except Exception as e:
+                print(f"❌ Error al cargar la página de listado {url}: {e}", file=sys.stderr)
+                listados_fallidos += 1
+
+        browser.close()
+
+    if listados_fallidos == len(urls_listado):
+        print("❌ No se pudo cargar ningún listado. No se modifica el archivo de coches.", file=sys.stderr)
+        for w in workers:
+            detener_worker(w)
+        # Sin guardar nada, los trabajos de esta ejecución solo harían trabajo inútil en la siguiente
+        cola_trabajos.descartar(cola, encolados)
+        cola.close()
+        return
+
+    listado_terminado.set()
+    for ronda in range(RONDAS_WORKERS + 1):
+        # Un Chromium colgado no puede bloquear la ejecución indefinidamente
+        limite = time.time() + TIMEOUT_WORKERS
+        for w in workers:
+            w.join(max(0, limite - time.time()))
+            if w.is_alive():
+                print("⚠️ Worker sin terminar tras el tiempo máximo, se detiene.", file=sys.stderr)
+                detener_worker(w)
+        # Los trabajos de workers muertos o detenidos vuelven a la cola
+        cola_trabajos.reiniciar_en_curso(cola)
+        if cola_trabajos.contar_pendientes(cola) == 0:
+            break
+        if ronda == RONDAS_WORKERS:
+            print("⚠️ Quedan trabajos sin terminar; se guardan con los datos del listado.", file=sys.stderr)
+            break
+        print(f"⚠️ Quedan trabajos sin terminar, relanzando workers ({ronda + 1})...", file=sys.stderr)
+        workers = lanzar_workers(ctx, num_workers, listado_terminado)
+
+    for car_data in cola_trabajos.resultados(cola):
+        if car_data.get("url") in final_by_url:
+            final_by_url[car_data["url"]] = car_data
+    cola_trabajos.vaciar(cola)
+    cola.close()
+
+    final_data = list(final_by_url.values())
+
+    if listados_fallidos:
+        # Sin el listado completo no se sabe qué coches han desaparecido: se conservan, no se archivan
+        print(f"⚠️ {listados_fallidos} listados fallaron. Los coches no vistos se conservan sin archivar.")
+        for car in existing_data:
+            if car.get("estado_actualizacion") == "no actualizado":
+                car["estado_actualizacion"] = "sin_cambios"
+                final_data.append(car)
 
     eliminados_data = [
         {**car, "fecha_eliminación": datetime.now().strftime("%d-%m-%Y %H:%M")}
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Índice local de similitud entre coches (MinHash + LSH, sin servicios externos).
+• Detecta anuncios casi idénticos (mismo modelo, motor, año y cuota que solo cambian en URL o color)
+  para reutilizar su análisis en vez de volver a pagarlo a OpenAI.
+• Modelo, motor, año y descripción deben coincidir exactamente (clave de bloqueo);
+  MinHash solo compara el resto de características y la cuota se compara numéricamente.
+"""
+
+import json
+import os
+import random
+import re
+import unicodedata
+import zlib
+from typing import List, Dict, Optional
+
+NUM_PERMUTACIONES = 64
+FILAS_POR_BANDA = 4
+UMBRAL_SIMILITUD = float(os.getenv("UMBRAL_SIMILITUD", "0.9"))
+# Cuotas que se diferencian como mucho en esto se consideran equivalentes; el beneficio se recalcula con la cuota real
+TRAMO_PRECIO = float(os.getenv("TRAMO_PRECIO_SIMILITUD", "25"))
+
+# Campos que identifican el coche: deben coincidir exactamente. La etiqueta depende del año
+# y puntos_extra/ponderación de lo que el modelo lee en la descripción.
+CAMPOS_CLAVE = ["modelo", "motor_info", "año", "descripcion"]
+
+# Campos que no describen el coche en sí o que dependen del análisis
+CAMPOS_IGNORADOS = set(CAMPOS_CLAVE) | {
+    "url", "precio", "color", "kilometraje", "km_por_año", "estado_actualizacion", "fecha_eliminación",
+    "precio_alquiler_dia", "ingresos_mensuales", "coste_renting", "beneficio_neto",
+    "etiqueta_ambiental", "consumo", "puntos_extra", "ponderación", "segmento",
+}
+
+# Campos del análisis que se heredan tal cual del coche equivalente
+CAMPOS_CLASIFICACION = [
+    "segmento", "precio_alquiler_dia", "ingresos_mensuales", "etiqueta_ambiental",
+    "consumo", "puntos_extra", "ponderación",
+]
+
+_PRIMO = (1 << 61) - 1
+_rng = random.Random(20240901)  # Semilla fija: las firmas guardadas deben ser comparables entre ejecuciones
+_COEFICIENTES = [(_rng.randrange(1, _PRIMO), _rng.randrange(0, _PRIMO)) for _ in range(NUM_PERMUTACIONES)]
+
+
+def normalizar(texto) -> str:
+    """Minúsculas, sin tildes y sin signos de puntuación."""
+    texto = unicodedata.normalize("NFKD", str(texto)).encode("ascii", "ignore").decode("ascii")
+    return re.sub(r"[^a-z0-9]+", " ", texto.lower()).strip()
+
+
+def extraer_precio(precio) -> Optional[float]:
+    """
+    '1.039,50 € al mes' -> 1039.5. El punto solo es separador de miles si le siguen 3 cifras;
+    ante un formato ambiguo ('299.99 €') devuelve None en vez de adivinar.
+    """
+    if isinstance(precio, (int, float)):
+        return float(precio)
+    m = re.search(r"\d[\d.,]*", str(precio or ""))
+    if not m:
+        return None
+    numero = m.group(0).rstrip(".,")
+    if not re.fullmatch(r"\d{1,3}(?:\.\d{3})+(?:,\d+)?|\d+(?:,\d+)?", numero):
+        return None
+    return float(numero.replace(".", "").replace(",", "."))
+
+
+def clave_bloqueo(coche: Dict) -> Optional[str]:
+    """
+    Clave exacta con los campos identificativos normalizados.
+    None si falta alguno (p. ej. no se pudieron obtener los detalles): ese coche no se compara.
+    """
+    valores = [normalizar(coche.get(campo) or "") for campo in CAMPOS_CLAVE]
+    if not all(valores):
+        return None
+    return "|".join(valores)
+
+
+def tokens_de_coche(coche: Dict) -> set:
+    """Conjunto de tokens 'campo:palabra' con el resto de campos descriptivos del coche."""
+    tokens = set()
+    for campo, valor in coche.items():
+        if campo in CAMPOS_IGNORADOS or valor in (None, ""):
+            continue
+        nombre = normalizar(campo)
+        for palabra in normalizar(valor).split():
+            tokens.add(f"{nombre}:{palabra}")
+    return tokens
+
+
+def firma_minhash(coche: Dict) -> List[int]:
+    """Firma MinHash del coche. Es estable entre ejecuciones (no usa hash() de Python)."""
+    hashes = [zlib.crc32(t.encode("utf-8")) for t in tokens_de_coche(coche)]
+    if not hashes:
+        return [_PRIMO] * NUM_PERMUTACIONES
+    return [min((a * h + b) % _PRIMO for h in hashes) for a, b in _COEFICIENTES]
+
+
+def similitud(firma_a: List[int], firma_b: List[int]) -> float:
+    """Estimación de la similitud de Jaccard entre dos firmas."""
+    return sum(1 for x, y in zip(firma_a, firma_b) if x == y) / NUM_PERMUTACIONES
+
+
+def _claves_banda(clave: str, firma: List[int]) -> List[str]:
+    return [
+        f"{clave}#{i}:" + ",".join(map(str, firma[i:i + FILAS_POR_BANDA]))
+        for i in range(0, NUM_PERMUTACIONES, FILAS_POR_BANDA)
+    ]
+
+
+def crear_indice(entradas: Optional[List[Dict]] = None) -> Dict:
+    """
+    Crea un índice a partir de entradas {"url", "clave", "firma", "precio", "analisis"}.
+    Las bandas LSH evitan comparar cada coche nuevo con todo el histórico.
+    """
+    indice = {"entradas": [], "bandas": {}}
+    for entrada in entradas or []:
+        if entrada.get("clave") is None:
+            continue  # Entradas de versiones anteriores sin clave de bloqueo
+        añadir_al_indice(
+            indice, entrada["url"], entrada["clave"], entrada["firma"], entrada.get("precio"), entrada.get("analisis")
+        )
+    return indice
+
+
+def añadir_al_indice(
+    indice: Dict, url: str, clave: str, firma: List[int], precio: Optional[float], analisis: Optional[Dict]
+) -> Dict:
+    """Añade un coche al índice y devuelve su entrada."""
+    entrada = {"url": url, "clave": clave, "firma": firma, "precio": precio, "analisis": analisis}
+    posicion = len(indice["entradas"])
+    indice["entradas"].append(entrada)
+    for clave_banda in _claves_banda(clave, firma):
+        indice["bandas"].setdefault(clave_banda, []).append(posicion)
+    return entrada
+
+
+def buscar_similar(
+    indice: Dict, clave: str, firma: List[int], precio: Optional[float], umbral: float = UMBRAL_SIMILITUD
+) -> Optional[Dict]:
+    """
+    Devuelve la entrada con la misma clave, cuota a menos de TRAMO_PRECIO
+    y similitud >= umbral más parecida, o None.
+    """
+    if precio is None:
+        return None
+    candidatos = set()
+    for clave_banda in _claves_banda(clave, firma):
+        candidatos.update(indice["bandas"].get(clave_banda, []))
+
+    mejor, mejor_similitud = None, umbral
+    for posicion in candidatos:
+        entrada = indice["entradas"][posicion]
+        if entrada["clave"] != clave:
+            continue
+        if entrada.get("precio") is None or abs(entrada["precio"] - precio) > TRAMO_PRECIO:
+            continue
+        s = similitud(firma, entrada["firma"])
+        if s >= mejor_similitud:
+            mejor, mejor_similitud = entrada, s
+    return mejor
+
+
+def cargar_indice(path: str) -> Dict:
+    """Carga el índice guardado en disco. Si no existe o está dañado, empieza vacío."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return crear_indice(json.load(f))
+    except FileNotFoundError:
+        return crear_indice()
+    except (json.JSONDecodeError, KeyError, TypeError) as e:
+        print(f"⚠️ Índice de similitud inválido en {path}: {e}. Se crea uno nuevo.")
+        return crear_indice()
+
+
+def guardar_indice(indice: Dict, path: str):
+    """Guarda solo las entradas con análisis; las bandas se reconstruyen al cargar."""
+    entradas = [e for e in indice["entradas"] if e.get("analisis")]
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(entradas, f, ensure_ascii=False)
+
+
+def heredar_analisis(coche: Dict, analisis: Dict) -> Dict:
+    """
+    Copia al coche la clasificación de un coche equivalente y recalcula
+    los importes que dependen de su propia cuota de renting.
+    """
+    heredado = {"url": coche.get("url")}
+    for campo in CAMPOS_CLASIFICACION:
+        if campo in analisis:
+            heredado[campo] = analisis[campo]
+
+    coste_renting = extraer_precio(coche.get("precio"))
+    if coste_renting is None:
+        coste_renting = analisis.get("coste_renting")
+    heredado["coste_renting"] = coste_renting
+    if coste_renting is not None and heredado.get("ingresos_mensuales") is not None:
+        heredado["beneficio_neto"] = round(heredado["ingresos_mensuales"] - coste_renting, 2)
+    else:
+        heredado["beneficio_neto"] = analisis.get("beneficio_neto")
+    return heredado